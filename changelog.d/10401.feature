@@ -0,0 +1 @@
+Match the scheme and host of URLs in `sso.client_whitelist` case-insensitively, strip surrounding whitespace from whitelist entries, and drop duplicate or redundant entries.
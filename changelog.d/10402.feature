@@ -0,0 +1 @@
+Cache compiled templates on disk so that they do not need to be compiled again when Synapse restarts. The cache can be turned off with the `SYNAPSE_DISABLE_TEMPLATE_BYTECODE_CACHE` environment variable; see `docs/templates.md`.
@@ -16,19 +16,43 @@
 
 import argparse
 import errno
+import functools
 import os
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from textwrap import dedent
-from typing import Any, Iterable, List, MutableMapping, Optional, Union
+from types import CodeType
+from typing import Any, Dict, Iterable, List, MutableMapping, Optional, Tuple, Union
 
 import attr
 import jinja2
 import pkg_resources
 import yaml
 
+from synapse.util.stringutils import strtobool
 from synapse.util.templates import _create_mxc_to_http_filter, _format_ts_filter
 
+# Use the libyaml-based loader to parse config files where it is available, since it
+# is much faster than the pure-Python one.
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Whether to cache compiled templates on disk, so that they do not need to be compiled
+# again when Synapse restarts. See docs/templates.md.
+TEMPLATE_BYTECODE_CACHE = not strtobool(
+    os.environ.get("SYNAPSE_DISABLE_TEMPLATE_BYTECODE_CACHE", "0")
+)
+
+# Whether to read several templates at once using a pool of threads. This can be
+# turned off for environments where starting threads is undesirable. See
+# docs/templates.md.
+PARALLEL_TEMPLATE_READS = not strtobool(
+    os.environ.get("SYNAPSE_SERIAL_TEMPLATE_READS", "0")
+)
+
+# The maximum number of threads to use to read templates.
+_MAX_TEMPLATE_READ_THREADS = 8
+
 
 class ConfigError(Exception):
     """Represents a problem parsing the configuration
@@ -97,6 +121,110 @@ def path_exists(file_path):
         return False
 
 
+class _TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """A cache of compiled templates, which persists across restarts.
+
+    Templates are stored in a per-user directory (`_jinja2-cache-<uid>`) under the
+    system's temporary directory, and are keyed on a checksum of their source, so
+    any changes to a template are picked up.
+
+    Failing to write to the cache doesn't prevent the template from being used.
+    """
+
+    def dump_bytecode(self, bucket: jinja2.bccache.Bucket) -> None:
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            # The template has been compiled successfully, so we can carry on
+            # without caching it.
+            pass
+
+
+def _build_bytecode_cache() -> Optional[jinja2.BytecodeCache]:
+    """Build a bytecode cache for Jinja environments, if possible.
+
+    Returns:
+        The bytecode cache, or None if caching is turned off or a cache directory
+        could not be created.
+    """
+    if not TEMPLATE_BYTECODE_CACHE:
+        return None
+
+    try:
+        return _TemplateBytecodeCache()
+    except (OSError, RuntimeError):
+        return None
+
+
+def _compile_template(
+    env: jinja2.Environment, source: str, name: str, filename: str
+) -> CodeType:
+    """Compile a template, using the environment's bytecode cache if it has one.
+
+    This mirrors what Jinja's loaders do when loading a template by name.
+
+    Args:
+        env: The environment to compile the template for.
+
+        source: The source of the template.
+
+        name: The name of the template.
+
+        filename: The path the template was loaded from.
+
+    Returns:
+        The compiled template.
+    """
+    bcc = env.bytecode_cache
+    if bcc is None:
+        return env.compile(source, name, filename)
+
+    bucket = bcc.get_bucket(env, name, filename, source)
+    if bucket.code is None:
+        bucket.code = env.compile(source, name, filename)
+        bcc.set_bucket(bucket)
+    return bucket.code
+
+
+@functools.lru_cache(maxsize=32)
+def _get_jinja_env(
+    search_directories: Tuple[str, ...], public_baseurl: Optional[str]
+) -> jinja2.Environment:
+    """Get a Jinja environment which loads templates from the given directories.
+
+    Environments are cached, so that config sections which load templates from the
+    same directories share a single environment, and with it the environment's
+    cache of compiled templates. Compiled templates are also cached on disk, so that
+    they do not need to be compiled again when Synapse restarts.
+
+    Args:
+        search_directories: The directories to look for templates in, in order.
+
+        public_baseurl: The homeserver's public base URL, used by the
+            `mxc_to_http` filter.
+
+    Returns:
+        A jinja2 environment.
+    """
+    # TODO: switch to synapse.util.templates.build_jinja_env
+    loader = jinja2.FileSystemLoader(search_directories)
+    env = jinja2.Environment(
+        loader=loader,
+        autoescape=jinja2.select_autoescape(),
+        bytecode_cache=_build_bytecode_cache(),
+    )
+
+    # Update the environment with our custom filters
+    env.filters.update(
+        {
+            "format_ts": _format_ts_filter,
+            "mxc_to_http": _create_mxc_to_http_filter(public_baseurl),
+        }
+    )
+
+    return env
+
+
 class Config:
     """
     A configuration section, containing configuration keys and values.
@@ -110,6 +238,10 @@ class Config:
 
     section = None
 
+    # Subclasses which list the attributes they set in __slots__ do not need a
+    # per-instance __dict__. Subclasses which don't define __slots__ get one as usual.
+    __slots__ = ("root", "default_template_dir")
+
     def __init__(self, root_config=None):
         self.root = root_config
 
@@ -234,6 +366,65 @@ class Config:
         """
         return self.read_templates([filename])[0]
 
+    def _bulk_read_templates(
+        self,
+        filenames: List[str],
+        custom_template_directory: Optional[str] = None,
+    ) -> List[jinja2.Template]:
+        """Load a list of template files from disk, scanning each template directory
+        only once.
+
+        This behaves like `read_templates`, except that rather than looking for each
+        template in each directory in turn, the contents of each directory are listed
+        up front. This saves a number of filesystem calls when loading several
+        templates at once.
+
+        Args:
+            filenames: A list of template filenames to read.
+
+            custom_template_directory: A directory to try to look for the templates
+                before using the default Synapse template directory instead.
+
+        Raises:
+            ConfigError: if the custom template directory does not exist.
+            jinja2.TemplateNotFound: if a template could not be found in any of the
+                directories.
+
+        Returns:
+            A list of jinja2 templates.
+        """
+        search_directories = self._get_template_search_directories(
+            custom_template_directory
+        )
+        env = _get_jinja_env(search_directories, self.public_baseurl)
+
+        # Find the path of each template, preferring earlier directories.
+        wanted = set(filenames)
+        paths: Dict[str, str] = {}
+        for directory in reversed(search_directories):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name in wanted:
+                        paths[entry.name] = entry.path
+
+        templates = []
+        for filename in filenames:
+            path = paths.get(filename)
+            if path is None:
+                raise jinja2.TemplateNotFound(filename)
+
+            with open(path, "rb") as f:
+                source = f.read().decode("utf-8")
+
+            # Compile the template with its name, so that (for example) autoescaping
+            # is chosen based on its file extension, as it would be by the loader.
+            code = _compile_template(env, source, filename, path)
+            templates.append(
+                env.template_class.from_code(env, code, env.make_globals(None))
+            )
+
+        return templates
+
     def read_templates(
         self,
         filenames: List[str],
@@ -260,6 +451,31 @@ class Config:
         Returns:
             A list of jinja2 templates.
         """
+        search_directories = self._get_template_search_directories(
+            custom_template_directory
+        )
+        env = _get_jinja_env(search_directories, self.public_baseurl)
+
+        # Load the templates. Reading and compiling each template is independent and
+        # mostly spent waiting on the disk, so when there are several to load, do so
+        # in parallel.
+        if not PARALLEL_TEMPLATE_READS or len(filenames) <= 2:
+            return [env.get_template(filename) for filename in filenames]
+
+        # The pool is shut down once we're done with it, rather than being kept
+        # around, since its threads would not survive Synapse daemonizing.
+        max_workers = min(_MAX_TEMPLATE_READ_THREADS, len(filenames))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(env.get_template, filenames))
+
+    def _get_template_search_directories(
+        self, custom_template_directory: Optional[str]
+    ) -> Tuple[str, ...]:
+        """Get the directories to look for templates in, in order of preference.
+
+        Raises:
+            ConfigError: if the custom template directory does not exist.
+        """
         search_directories = [self.default_template_dir]
 
         # The loader will first look in the custom template directory (if specified) for the
@@ -275,23 +491,7 @@ class Config:
             # Search the custom template directory as well
             search_directories.insert(0, custom_template_directory)
 
-        # TODO: switch to synapse.util.templates.build_jinja_env
-        loader = jinja2.FileSystemLoader(search_directories)
-        env = jinja2.Environment(
-            loader=loader,
-            autoescape=jinja2.select_autoescape(),
-        )
-
-        # Update the environment with our custom filters
-        env.filters.update(
-            {
-                "format_ts": _format_ts_filter,
-                "mxc_to_http": _create_mxc_to_http_filter(self.public_baseurl),
-            }
-        )
-
-        # Load the templates
-        return [env.get_template(filename) for filename in filenames]
+        return tuple(search_directories)
 
 
 class RootConfig:
@@ -692,7 +892,7 @@ class RootConfig:
                     config_file.write(config_str)
                     config_file.write("\n\n# vim:ft=yaml")
 
-                config_dict = yaml.safe_load(config_str)
+                config_dict = yaml.load(config_str, Loader=_YamlLoader)
                 obj.generate_missing_files(config_dict, config_dir_path)
 
                 print(
@@ -760,7 +960,7 @@ def read_config_files(config_files):
     specified_config = {}
     for config_file in config_files:
         with open(config_file) as file_stream:
-            yaml_config = yaml.safe_load(file_stream)
+            yaml_config = yaml.load(file_stream, Loader=_YamlLoader)
 
         if not isinstance(yaml_config, dict):
             err = "File %r is empty or doesn't parse into a key-value map. IGNORING."
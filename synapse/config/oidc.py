@@ -332,7 +332,7 @@ OIDC_PROVIDER_CONFIG_SCHEMA = {
         "user_mapping_provider": {"type": ["object", "null"]},
         "attribute_requirements": {
             "type": "array",
-            "items": SsoAttributeRequirement.JSON_SCHEMA,
+            "items": SsoAttributeRequirement.json_schema(),
         },
     },
 }
@@ -411,7 +411,7 @@ class SAML2Config(Config):
 
 ATTRIBUTE_REQUIREMENTS_SCHEMA = {
     "type": "array",
-    "items": SsoAttributeRequirement.JSON_SCHEMA,
+    "items": SsoAttributeRequirement.json_schema(),
 }
 
 
@@ -11,14 +11,61 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Any, Dict, Optional
+import functools
+import re
+import urllib.parse
+from types import MappingProxyType
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Pattern,
+    Tuple,
+)
 
 import attr
+import jinja2
+import pkg_resources
 
-from ._base import Config
+from ._base import Config, ConfigError
 
+# Templates which have no placeholders are rendered once and the result kept here
+# for the lifetime of the process, keyed by (template directory, filename).
+_RENDERED_TEMPLATE_CACHE: Dict[Tuple[Optional[str], str], str] = {}
 
-@attr.s(frozen=True)
+# Used in place of an unset (or null) `client_whitelist`.
+_EMPTY_WHITELIST: Tuple[str, ...] = ()
+
+
+def _freeze(value: Any) -> Any:
+    """Make a read-only copy of a JSON-like value, by recursively replacing dicts
+    with read-only mappings and lists with tuples.
+    """
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    """Make a mutable copy of a value frozen by `_freeze`.
+
+    jsonschema only accepts dicts and lists in schemas, so frozen values must be
+    thawed before being used as (or in) a schema.
+    """
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_thaw(v) for v in value]
+    return value
+
+
+@attr.s(slots=True, frozen=True)
 class SsoAttributeRequirement:
     """Object describing a single requirement for SSO attributes."""
 
@@ -26,11 +73,257 @@ class SsoAttributeRequirement:
     # If a value is not given, than the attribute must simply exist.
     value = attr.ib(type=Optional[str])
 
-    JSON_SCHEMA = {
-        "type": "object",
-        "properties": {"attribute": {"type": "string"}, "value": {"type": "string"}},
-        "required": ["attribute", "value"],
-    }
+    # The schema is frozen, since it is shared by everything which validates a
+    # requirement. Use `json_schema()` to get a copy to pass to jsonschema.
+    JSON_SCHEMA = _freeze(
+        {
+            "type": "object",
+            "properties": {
+                "attribute": {"type": "string"},
+                "value": {"type": "string"},
+            },
+            "required": ["attribute", "value"],
+        }
+    )
+
+    @staticmethod
+    def json_schema() -> Dict[str, Any]:
+        """Get a copy of JSON_SCHEMA which can be used (or embedded) as a jsonschema
+        schema.
+        """
+        return _thaw(SsoAttributeRequirement.JSON_SCHEMA)
+
+
+# The templates used during single sign-on, keyed by the name they are looked up by
+# in `SSOConfig.sso_templates`.
+_SSO_TEMPLATE_FILES = {
+    "login_idp_picker": "sso_login_idp_picker.html",
+    "redirect_confirm": "sso_redirect_confirm.html",
+    "auth_confirm": "sso_auth_confirm.html",
+    "error": "sso_error.html",
+    "auth_bad_user": "sso_auth_bad_user.html",
+    "account_deactivated": "sso_account_deactivated.html",
+    "auth_success": "sso_auth_success.html",
+}
+
+# These templates have no placeholders, so their output can be rendered once and
+# reused. See `_SsoTemplates.rendered`.
+_RENDERED_SSO_TEMPLATES = frozenset(("account_deactivated", "auth_success"))
+
+
+class _SsoTemplates(Mapping[str, jinja2.Template]):
+    """The HTML templates used during single sign-on, keyed by name.
+
+    Templates are read from disk and compiled the first time they are used, rather
+    than when the config is parsed, since many homeservers never use SSO.
+
+    The output of templates which have no placeholders is available, already
+    rendered, from `rendered`.
+    """
+
+    def __init__(self, config: Config, template_dir: Optional[str]):
+        self._config = config
+        self._template_dir = template_dir
+        self._templates: Dict[str, jinja2.Template] = {}
+
+    def __getitem__(self, name: str) -> jinja2.Template:
+        return self._load_template(_SSO_TEMPLATE_FILES[name])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(_SSO_TEMPLATE_FILES)
+
+    def __len__(self) -> int:
+        return len(_SSO_TEMPLATE_FILES)
+
+    def load_all(self) -> None:
+        """Read all of the templates from disk now, rather than on first use."""
+        filenames = [
+            filename
+            for filename in _SSO_TEMPLATE_FILES.values()
+            if filename not in self._templates
+        ]
+        if filenames:
+            # If there is a custom template directory, read all of the templates in a
+            # single pass over it rather than looking for each one in turn.
+            if self._template_dir:
+                templates = self._config._bulk_read_templates(
+                    filenames, self._template_dir
+                )
+            else:
+                templates = self._config.read_templates(filenames)
+            self._templates.update(zip(filenames, templates))
+
+        # Looking up each template loads it.
+        for name in self:
+            self[name]
+        for name in _RENDERED_SSO_TEMPLATES:
+            self.rendered(name)
+
+    def rendered(self, name: str) -> str:
+        """Get the output of the named template, which must have no placeholders.
+
+        The rendered output is cached for the lifetime of the process, so that
+        subsequent config loads (for example when generating config for several
+        workers) do not need to read and compile the template again.
+
+        Raises:
+            KeyError: if there is no such template, or it has placeholders.
+        """
+        if name not in _RENDERED_SSO_TEMPLATES:
+            raise KeyError(name)
+
+        filename = _SSO_TEMPLATE_FILES[name]
+        key = (self._template_dir, filename)
+        rendered = _RENDERED_TEMPLATE_CACHE.get(key)
+        if rendered is None:
+            rendered = self._load_template(filename).render()
+            _RENDERED_TEMPLATE_CACHE[key] = rendered
+        return rendered
+
+    def _load_template(self, filename: str) -> jinja2.Template:
+        template = self._templates.get(filename)
+        if template is None:
+            template = self._config.read_templates([filename], self._template_dir)[0]
+            self._templates[filename] = template
+        return template
+
+
+@functools.lru_cache(maxsize=32)
+def _login_fallback_url(public_baseurl: str) -> str:
+    """Get the URL of the login fallback page for the given public base URL."""
+    return public_baseurl + "_matrix/static/client/login"
+
+
+def _canonicalise_url(url: str) -> str:
+    """Canonicalise a URL, or a prefix of one, for prefix matching.
+
+    The scheme and host (which are case-insensitive) are lower-cased. The rest of
+    the URL, including any surrounding whitespace, is left untouched.
+    """
+    try:
+        parts = urllib.parse.urlsplit(url)
+    except ValueError:
+        return url
+
+    if not parts.scheme or not parts.netloc:
+        return url
+
+    # Only rewrite the URL if it starts with exactly "<scheme>://<netloc>": urlsplit
+    # may have discarded some characters (such as tabs) along the way.
+    authority = parts.scheme + "://" + parts.netloc
+    if url[: len(authority)].lower() != authority.lower():
+        return url
+
+    userinfo, sep, host = parts.netloc.rpartition("@")
+    return parts.scheme + "://" + userinfo + sep + host.lower() + url[len(authority) :]
+
+
+def _canonicalise_url_prefix(prefix: str) -> str:
+    """Canonicalise a configured URL prefix, as `_canonicalise_url` does, after
+    removing any surrounding whitespace.
+    """
+    return _canonicalise_url(prefix.strip())
+
+
+def _canonicalise_prefixes(prefixes: Iterable[str]) -> List[str]:
+    """Canonicalise a list of URL prefixes, removing any redundant entries.
+
+    An entry is redundant if it is a duplicate, or if it starts with another entry
+    in the list, since anything matching it would match the shorter entry anyway.
+
+    Args:
+        prefixes: the URL prefixes to canonicalise.
+
+    Returns:
+        The remaining prefixes, in their original order.
+    """
+    canonical = []
+    for prefix in prefixes:
+        canonical_prefix = _canonicalise_url_prefix(prefix)
+        # Skip entries which were only whitespace, rather than letting them match
+        # every URL.
+        if prefix and not canonical_prefix:
+            continue
+        canonical.append(canonical_prefix)
+
+    # Remove duplicates, keeping the first occurrence of each.
+    canonical = list(dict.fromkeys(canonical))
+
+    # Checking the shortest prefixes first means that any entry which is subsumed
+    # by another is found after the entry which subsumes it.
+    kept: List[str] = []
+    for prefix in sorted(canonical, key=len):
+        if not any(prefix.startswith(k) for k in kept):
+            kept.append(prefix)
+
+    kept_set = set(kept)
+    return [prefix for prefix in canonical if prefix in kept_set]
+
+
+def _compile_prefix_pattern(prefixes: Iterable[str]) -> Pattern[str]:
+    """Build a regular expression which matches strings starting with any of the
+    given prefixes.
+
+    Matching a string against the pattern happens in a single call into the regex
+    engine, rather than checking each prefix in turn.
+    """
+    # Try longer prefixes first, so that the match is the longest possible one.
+    alternatives = sorted(prefixes, key=len, reverse=True)
+    if not alternatives:
+        # An empty alternation would match everything, so use a pattern which
+        # can never match instead.
+        return re.compile("(?!)")
+    return re.compile("(?:%s)" % ("|".join(map(re.escape, alternatives)),))
+
+
+def _is_sso_configured(root: Any, config: Dict[str, Any]) -> bool:
+    """Check whether the homeserver config could lead to the SSO templates being used.
+
+    Args:
+        root: the root config. Its SAML2, OIDC, CAS and modules sections, where it
+            has them, are parsed before the SSO section, so are used as they are.
+
+        config: the homeserver config. This is used to check for password
+            providers, since their section is parsed after the SSO section.
+
+    Returns:
+        True if an OpenID Connect, SAML2 or CAS provider is enabled, or if there
+        are any password providers or modules (which may complete SSO logins via the
+        module API).
+    """
+    for section, enabled_attr in (
+        ("saml2", "saml2_enabled"),
+        ("oidc", "oidc_enabled"),
+        ("cas", "cas_enabled"),
+    ):
+        if getattr(getattr(root, section, None), enabled_attr, False):
+            return True
+
+    if getattr(getattr(root, "modules", None), "loaded_modules", None):
+        return True
+
+    ldap_config = config.get("ldap_config") or {}
+    return bool(config.get("password_providers") or ldap_config.get("enabled", False))
+
+
+def _template_property(name: str) -> property:
+    """Build a property which returns the named template from `sso_templates`."""
+
+    def _get(self: "SSOConfig") -> jinja2.Template:
+        return self.sso_templates[name]
+
+    return property(_get)
+
+
+def _rendered_template_property(name: str) -> property:
+    """Build a property which returns the rendered output of the named template from
+    `sso_templates`.
+    """
+
+    def _get(self: "SSOConfig") -> str:
+        return self.sso_templates.rendered(name)
+
+    return property(_get)
 
 
 class SSOConfig(Config):
@@ -38,44 +331,60 @@ class SSOConfig(Config):
 
     section = "sso"
 
+    __slots__ = (
+        "sso_template_dir",
+        "sso_templates",
+        "sso_client_whitelist",
+        "sso_client_whitelist_re",
+        "sso_update_profile_information",
+    )
+
+    # The individual templates, for code which predates `sso_templates`.
+    sso_login_idp_picker_template = _template_property("login_idp_picker")
+    sso_redirect_confirm_template = _template_property("redirect_confirm")
+    sso_auth_confirm_template = _template_property("auth_confirm")
+    sso_error_template = _template_property("error")
+    sso_auth_bad_user_template = _template_property("auth_bad_user")
+    sso_account_deactivated_template = _rendered_template_property(
+        "account_deactivated"
+    )
+    sso_auth_success_template = _rendered_template_property("auth_success")
+
     def read_config(self, config, **kwargs):
         sso_config: Dict[str, Any] = config.get("sso") or {}
 
         # The sso-specific template_dir
         self.sso_template_dir = sso_config.get("template_dir")
 
-        # Read templates from disk
-        (
-            self.sso_login_idp_picker_template,
-            self.sso_redirect_confirm_template,
-            self.sso_auth_confirm_template,
-            self.sso_error_template,
-            sso_account_deactivated_template,
-            sso_auth_success_template,
-            self.sso_auth_bad_user_template,
-        ) = self.read_templates(
-            [
-                "sso_login_idp_picker.html",
-                "sso_redirect_confirm.html",
-                "sso_auth_confirm.html",
-                "sso_error.html",
-                "sso_account_deactivated.html",
-                "sso_auth_success.html",
-                "sso_auth_bad_user.html",
-            ],
-            self.sso_template_dir,
-        )
+        # Check that the template directory exists now, rather than when the
+        # templates are first used.
+        if self.sso_template_dir and not self.path_exists(self.sso_template_dir):
+            raise ConfigError(
+                "Configured template directory does not exist: %s"
+                % (self.sso_template_dir,)
+            )
 
-        # These templates have no placeholders, so render them here
-        self.sso_account_deactivated_template = (
-            sso_account_deactivated_template.render()
-        )
-        self.sso_auth_success_template = sso_auth_success_template.render()
+        # The templates are read from disk on first use. If SSO is configured they
+        # will be needed anyway, so read them now so that any problems with them are
+        # reported at startup; otherwise skip loading them entirely.
+        self.sso_templates = _SsoTemplates(self, self.sso_template_dir)
+        if _is_sso_configured(self.root, config):
+            self.sso_templates.load_all()
+
+        client_whitelist = sso_config.get("client_whitelist") or _EMPTY_WHITELIST
+        if not isinstance(client_whitelist, (list, tuple)) or not all(
+            isinstance(entry, str) for entry in client_whitelist
+        ):
+            raise ConfigError(
+                "'client_whitelist' must be a list of strings",
+                ("sso", "client_whitelist"),
+            )
 
-        self.sso_client_whitelist = sso_config.get("client_whitelist") or []
+        # Take a copy of the configured list, since we may append to it below.
+        self.sso_client_whitelist = list(client_whitelist)
 
-        self.sso_update_profile_information = (
-            sso_config.get("update_profile_information") or False
+        self.sso_update_profile_information = bool(
+            sso_config.get("update_profile_information", False)
         )
 
         # Attempt to also whitelist the server's login fallback, since that fallback sets
@@ -86,206 +395,32 @@ class SSOConfig(Config):
         # public_baseurl is an optional setting, so we only add the fallback's URL to the
         # list if it's provided (because we can't figure out what that URL is otherwise).
         if self.public_baseurl:
-            login_fallback_url = self.public_baseurl + "_matrix/static/client/login"
-            self.sso_client_whitelist.append(login_fallback_url)
+            self.sso_client_whitelist.append(_login_fallback_url(self.public_baseurl))
 
-    def generate_config_section(self, **kwargs):
-        return """\
-        # Additional settings to use with single-sign on systems such as OpenID Connect,
-        # SAML2 and CAS.
-        #
-        sso:
-            # A list of client URLs which are whitelisted so that the user does not
-            # have to confirm giving access to their account to the URL. Any client
-            # whose URL starts with an entry in the following list will not be subject
-            # to an additional confirmation step after the SSO login is completed.
-            #
-            # WARNING: An entry such as "https://my.client" is insecure, because it
-            # will also match "https://my.client.evil.site", exposing your users to
-            # phishing attacks from evil.site. To avoid this, include a slash after the
-            # hostname: "https://my.client/".
-            #
-            # If public_baseurl is set, then the login fallback page (used by clients
-            # that don't natively support the required login flows) is whitelisted in
-            # addition to any URLs in this list.
-            #
-            # By default, this list is empty.
-            #
-            #client_whitelist:
-            #  - https://riot.im/develop
-            #  - https://my.custom.client/
-
-            # Uncomment to keep a user's profile fields in sync with information from
-            # the identity provider. Currently only syncing the displayname is
-            # supported. Fields are checked on every SSO login, and are updated
-            # if necessary.
-            #
-            # Note that enabling this option will override user profile information,
-            # regardless of whether users have opted-out of syncing that
-            # information when first signing in. Defaults to false.
-            #
-            #update_profile_information: true
-
-            # Directory in which Synapse will try to find the template files below.
-            # If not set, or the files named below are not found within the template
-            # directory, default templates from within the Synapse package will be used.
-            #
-            # Synapse will look for the following templates in this directory:
-            #
-            # * HTML page to prompt the user to choose an Identity Provider during
-            #   login: 'sso_login_idp_picker.html'.
-            #
-            #   This is only used if multiple SSO Identity Providers are configured.
-            #
-            #   When rendering, this template is given the following variables:
-            #     * redirect_url: the URL that the user will be redirected to after
-            #       login.
-            #
-            #     * server_name: the homeserver's name.
-            #
-            #     * providers: a list of available Identity Providers. Each element is
-            #       an object with the following attributes:
-            #
-            #         * idp_id: unique identifier for the IdP
-            #         * idp_name: user-facing name for the IdP
-            #         * idp_icon: if specified in the IdP config, an MXC URI for an icon
-            #              for the IdP
-            #         * idp_brand: if specified in the IdP config, a textual identifier
-            #              for the brand of the IdP
-            #
-            #   The rendered HTML page should contain a form which submits its results
-            #   back as a GET request, with the following query parameters:
-            #
-            #     * redirectUrl: the client redirect URI (ie, the `redirect_url` passed
-            #       to the template)
-            #
-            #     * idp: the 'idp_id' of the chosen IDP.
-            #
-            # * HTML page to prompt new users to enter a userid and confirm other
-            #   details: 'sso_auth_account_details.html'. This is only shown if the
-            #   SSO implementation (with any user_mapping_provider) does not return
-            #   a localpart.
-            #
-            #   When rendering, this template is given the following variables:
-            #
-            #     * server_name: the homeserver's name.
-            #
-            #     * idp: details of the SSO Identity Provider that the user logged in
-            #       with: an object with the following attributes:
-            #
-            #         * idp_id: unique identifier for the IdP
-            #         * idp_name: user-facing name for the IdP
-            #         * idp_icon: if specified in the IdP config, an MXC URI for an icon
-            #              for the IdP
-            #         * idp_brand: if specified in the IdP config, a textual identifier
-            #              for the brand of the IdP
-            #
-            #     * user_attributes: an object containing details about the user that
-            #       we received from the IdP. May have the following attributes:
-            #
-            #         * display_name: the user's display_name
-            #         * emails: a list of email addresses
-            #
-            #   The template should render a form which submits the following fields:
-            #
-            #     * username: the localpart of the user's chosen user id
-            #
-            # * HTML page allowing the user to consent to the server's terms and
-            #   conditions. This is only shown for new users, and only if
-            #   `user_consent.require_at_registration` is set.
-            #
-            #   When rendering, this template is given the following variables:
-            #
-            #     * server_name: the homeserver's name.
-            #
-            #     * user_id: the user's matrix proposed ID.
-            #
-            #     * user_profile.display_name: the user's proposed display name, if any.
-            #
-            #     * consent_version: the version of the terms that the user will be
-            #       shown
-            #
-            #     * terms_url: a link to the page showing the terms.
-            #
-            #   The template should render a form which submits the following fields:
-            #
-            #     * accepted_version: the version of the terms accepted by the user
-            #       (ie, 'consent_version' from the input variables).
-            #
-            # * HTML page for a confirmation step before redirecting back to the client
-            #   with the login token: 'sso_redirect_confirm.html'.
-            #
-            #   When rendering, this template is given the following variables:
-            #
-            #     * redirect_url: the URL the user is about to be redirected to.
-            #
-            #     * display_url: the same as `redirect_url`, but with the query
-            #                    parameters stripped. The intention is to have a
-            #                    human-readable URL to show to users, not to use it as
-            #                    the final address to redirect to.
-            #
-            #     * server_name: the homeserver's name.
-            #
-            #     * new_user: a boolean indicating whether this is the user's first time
-            #          logging in.
-            #
-            #     * user_id: the user's matrix ID.
-            #
-            #     * user_profile.avatar_url: an MXC URI for the user's avatar, if any.
-            #           None if the user has not set an avatar.
-            #
-            #     * user_profile.display_name: the user's display name. None if the user
-            #           has not set a display name.
-            #
-            # * HTML page which notifies the user that they are authenticating to confirm
-            #   an operation on their account during the user interactive authentication
-            #   process: 'sso_auth_confirm.html'.
-            #
-            #   When rendering, this template is given the following variables:
-            #     * redirect_url: the URL the user is about to be redirected to.
-            #
-            #     * description: the operation which the user is being asked to confirm
-            #
-            #     * idp: details of the Identity Provider that we will use to confirm
-            #       the user's identity: an object with the following attributes:
-            #
-            #         * idp_id: unique identifier for the IdP
-            #         * idp_name: user-facing name for the IdP
-            #         * idp_icon: if specified in the IdP config, an MXC URI for an icon
-            #              for the IdP
-            #         * idp_brand: if specified in the IdP config, a textual identifier
-            #              for the brand of the IdP
-            #
-            # * HTML page shown after a successful user interactive authentication session:
-            #   'sso_auth_success.html'.
-            #
-            #   Note that this page must include the JavaScript which notifies of a successful authentication
-            #   (see https://matrix.org/docs/spec/client_server/r0.6.0#fallback).
-            #
-            #   This template has no additional variables.
-            #
-            # * HTML page shown after a user-interactive authentication session which
-            #   does not map correctly onto the expected user: 'sso_auth_bad_user.html'.
-            #
-            #   When rendering, this template is given the following variables:
-            #     * server_name: the homeserver's name.
-            #     * user_id_to_verify: the MXID of the user that we are trying to
-            #       validate.
-            #
-            # * HTML page shown during single sign-on if a deactivated user (according to Synapse's database)
-            #   attempts to login: 'sso_account_deactivated.html'.
-            #
-            #   This template has no additional variables.
-            #
-            # * HTML page to display to users if something goes wrong during the
-            #   OpenID Connect authentication process: 'sso_error.html'.
-            #
-            #   When rendering, this template is given two variables:
-            #     * error: the technical name of the error
-            #     * error_description: a human-readable message for the error
-            #
-            # You can see the default templates at:
-            # https://github.com/matrix-org/synapse/tree/master/synapse/res/templates
-            #
-            #template_dir: "res/templates"
+        # Drop any duplicate or redundant entries, so that there is less to check
+        # against.
+        self.sso_client_whitelist = _canonicalise_prefixes(self.sso_client_whitelist)
+
+        # Compile the whitelisted URLs into a single pattern, so that checking a
+        # client's URL against them is one call into the regex engine. The list is
+        # kept for anything else which reads it.
+        self.sso_client_whitelist_re = _compile_prefix_pattern(
+            self.sso_client_whitelist
+        )
+
+    def is_sso_client_whitelisted(self, url: str) -> bool:
+        """Check whether the given client redirect URL starts with one of the
+        whitelisted prefixes.
+
+        The scheme and host of the URL are matched case-insensitively. Unlike the
+        whitelisted prefixes, the URL is not stripped of whitespace, since it is
+        used as-is when redirecting the client.
         """
+        return bool(self.sso_client_whitelist_re.match(_canonicalise_url(url)))
+
+    def generate_config_section(self, **kwargs):
+        # The sample config is kept in a separate file, so that it is only read when
+        # config is actually being generated.
+        return pkg_resources.resource_string(
+            "synapse", "res/config_templates/sso.yaml.tmpl"
+        ).decode("utf-8")
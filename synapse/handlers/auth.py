@@ -270,29 +270,25 @@ class AuthHandler(BaseHandler):
                 self._expire_old_sessions,
             )
 
-        # Load the SSO HTML templates.
-
-        # The following template is shown to the user during a client login via SSO,
-        # after the SSO completes and before redirecting them back to their client.
-        # It notifies the user they are about to give access to their matrix account
-        # to the client.
-        self._sso_redirect_confirm_template = hs.config.sso_redirect_confirm_template
-
-        # The following template is shown during user interactive authentication
-        # in the fallback auth scenario. It notifies the user that they are
-        # authenticating for an operation to occur on their account.
-        self._sso_auth_confirm_template = hs.config.sso_auth_confirm_template
-
-        # The following template is shown during the SSO authentication process if
-        # the account is deactivated.
-        self._sso_account_deactivated_template = (
-            hs.config.sso_account_deactivated_template
-        )
+        # The SSO HTML templates. These are loaded from disk the first time that
+        # they are used:
+        #
+        #  * `redirect_confirm` is shown to the user during a client login via SSO,
+        #    after the SSO completes and before redirecting them back to their
+        #    client. It notifies the user they are about to give access to their
+        #    matrix account to the client.
+        #
+        #  * `auth_confirm` is shown during user interactive authentication in the
+        #    fallback auth scenario. It notifies the user that they are
+        #    authenticating for an operation to occur on their account.
+        #
+        #  * `account_deactivated` is shown during the SSO authentication process if
+        #    the account is deactivated.
+        self._sso_templates = hs.config.sso.sso_templates
 
         self._server_name = hs.config.server_name
 
-        # cast to tuple for use with str.startswith
-        self._whitelisted_sso_clients = tuple(hs.config.sso_client_whitelist)
+        self._is_whitelisted_sso_client = hs.config.sso.is_sso_client_whitelisted
 
         # A mapping of user ID to extra attributes to include in the login
         # response.
@@ -1558,7 +1554,7 @@ class AuthHandler(BaseHandler):
             request, None, session_id
         )
 
-        return self._sso_auth_confirm_template.render(
+        return self._sso_templates["auth_confirm"].render(
             description=session.description,
             redirect_url=redirect_url,
             idp=sso_auth_provider,
@@ -1592,7 +1588,9 @@ class AuthHandler(BaseHandler):
         # flow.
         deactivated = await self.store.get_user_deactivated_status(registered_user_id)
         if deactivated:
-            respond_with_html(request, 403, self._sso_account_deactivated_template)
+            respond_with_html(
+                request, 403, self._sso_templates.rendered("account_deactivated")
+            )
             return
 
         profile = await self.store.get_profileinfo(
@@ -1650,7 +1648,7 @@ class AuthHandler(BaseHandler):
         )
 
         # if the client is whitelisted, we can redirect straight to it
-        if client_redirect_url.startswith(self._whitelisted_sso_clients):
+        if self._is_whitelisted_sso_client(client_redirect_url):
             request.redirect(redirect_url)
             finish_request(request)
             return
@@ -1674,7 +1672,7 @@ class AuthHandler(BaseHandler):
                 (url_parts.scheme, url_parts.netloc, url_parts.path, "", "")
             )
 
-        html = self._sso_redirect_confirm_template.render(
+        html = self._sso_templates["redirect_confirm"].render(
             display_url=display_url,
             redirect_url=redirect_url,
             server_name=self._server_name,
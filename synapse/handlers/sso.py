@@ -188,13 +188,10 @@ class SsoHandler:
         self._server_name = hs.hostname
         self._registration_handler = hs.get_registration_handler()
         self._auth_handler = hs.get_auth_handler()
-        self._error_template = hs.config.sso_error_template
-        self._bad_user_template = hs.config.sso_auth_bad_user_template
         self._profile_handler = hs.get_profile_handler()
 
-        # The following template is shown after a successful user interactive
-        # authentication session. It tells the user they can close the window.
-        self._sso_auth_success_template = hs.config.sso_auth_success_template
+        # The templates are loaded from disk the first time that they are used.
+        self._sso_templates = hs.config.sso.sso_templates
 
         self._sso_update_profile_information = hs.config.sso_update_profile_information
 
@@ -268,7 +265,7 @@ class SsoHandler:
             error_description: A human-readable description of the error.
             code: The integer error code (an HTTP response code)
         """
-        html = self._error_template.render(
+        html = self._sso_templates["error"].render(
             error=error, error_description=error_description
         )
         respond_with_html(request, code, html)
@@ -694,7 +691,7 @@ class SsoHandler:
             )
 
             # Render the HTML confirmation page and return.
-            html = self._sso_auth_success_template
+            html = self._sso_templates.rendered("auth_success")
             respond_with_html(request, 200, html)
             return
 
@@ -704,7 +701,7 @@ class SsoHandler:
         )
 
         # render an error page.
-        html = self._bad_user_template.render(
+        html = self._sso_templates["auth_bad_user"].render(
             server_name=self._server_name,
             user_id_to_verify=user_id_to_verify,
         )
@@ -38,9 +38,7 @@ class PickIdpResource(DirectServeHtmlResource):
     def __init__(self, hs: "HomeServer"):
         super().__init__()
         self._sso_handler = hs.get_sso_handler()
-        self._sso_login_idp_picker_template = (
-            hs.config.sso.sso_login_idp_picker_template
-        )
+        self._sso_templates = hs.config.sso.sso_templates
         self._server_name = hs.hostname
 
     async def _async_render_GET(self, request: SynapseRequest) -> None:
@@ -75,7 +73,7 @@ class PickIdpResource(DirectServeHtmlResource):
     ) -> None:
         # otherwise, serve up the IdP picker
         providers = self._sso_handler.get_identity_providers()
-        html = self._sso_login_idp_picker_template.render(
+        html = self._sso_templates["login_idp_picker"].render(
             redirect_url=client_redirect_url,
             server_name=self._server_name,
             providers=providers.values(),
@@ -14,8 +14,12 @@
 
 import os.path
 import tempfile
+from unittest.mock import patch
+
+import jinja2
 
 from synapse.config import ConfigError
+from synapse.config._base import _build_bytecode_cache
 from synapse.util.stringutils import random_string
 
 from tests import unittest
@@ -79,3 +83,88 @@ class BaseConfigTestCase(unittest.HomeserverTestCase):
             self.hs.config.read_templates(
                 ["some_filename.html"], "a_nonexistent_directory"
             )
+
+    def test_loading_templates_reuses_environment(self):
+        """Loading templates from the same directories should share a Jinja
+        environment, and hence its cache of compiled templates.
+        """
+        first = self.hs.config.read_templates(["sso_error.html"])[0]
+        second = self.hs.config.read_templates(["sso_error.html"])[0]
+
+        self.assertIs(first.environment, second.environment)
+        self.assertIs(first, second)
+
+    def test_loading_several_templates(self):
+        """Templates should be returned in the order they were asked for, whether or
+        not they are read in parallel.
+        """
+        filenames = [
+            "sso_error.html",
+            "sso_auth_success.html",
+            "sso_account_deactivated.html",
+            "sso_auth_bad_user.html",
+        ]
+        for parallel in (True, False):
+            with patch("synapse.config._base.PARALLEL_TEMPLATE_READS", parallel):
+                templates = self.hs.config.read_templates(filenames)
+            self.assertEqual([t.name for t in templates], filenames)
+
+    def test_loading_several_templates_with_missing_template(self):
+        with self.assertRaises(jinja2.TemplateNotFound):
+            self.hs.config.read_templates(
+                ["sso_error.html", "sso_auth_success.html", "some_filename.html"]
+            )
+
+    def test_bulk_loading_templates(self):
+        """Templates should be loaded from the custom directory where they exist,
+        and from the default directory otherwise.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "sso_error.html"), "w") as f:
+                f.write("custom: {{ error_description }}")
+
+            custom, default = self.hs.config._bulk_read_templates(
+                ["sso_error.html", "sso_auth_success.html"], tmp_dir
+            )
+
+        self.assertEqual(custom.render(error_description="<b>"), "custom: &lt;b&gt;")
+        self.assertIn("Thank you", default.render())
+
+    def test_bulk_loading_missing_template(self):
+        with self.assertRaises(jinja2.TemplateNotFound):
+            self.hs.config._bulk_read_templates(["some_filename.html"])
+
+    def test_compiled_templates_are_cached_on_disk(self):
+        """Compiled templates should be stored in the bytecode cache."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "test.html")
+            with open(path, "w") as f:
+                f.write("{{ test_variable }}")
+
+            template = self.hs.config.read_templates(["test.html"], tmp_dir)[0]
+
+            bcc = template.environment.bytecode_cache
+            self.assertIsNotNone(bcc)
+            bucket = bcc.get_bucket(
+                template.environment, "test.html", path, "{{ test_variable }}"
+            )
+            self.assertIsNotNone(bucket.code)
+
+    def test_compiled_templates_are_not_cached_when_disabled(self):
+        with patch("synapse.config._base.TEMPLATE_BYTECODE_CACHE", False):
+            self.assertIsNone(_build_bytecode_cache())
+
+    def test_loading_templates_when_cache_is_not_writable(self):
+        """Failing to write to the bytecode cache should not stop templates loading."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "test.html"), "w") as f:
+                f.write("{{ test_variable }}")
+
+            with patch.object(
+                jinja2.FileSystemBytecodeCache,
+                "dump_bytecode",
+                side_effect=PermissionError(),
+            ):
+                template = self.hs.config.read_templates(["test.html"], tmp_dir)[0]
+
+        self.assertEqual(template.render(test_variable="abc"), "abc")
@@ -0,0 +1,265 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+
+import jinja2
+import jsonschema
+
+from synapse.config._base import Config, ConfigError, RootConfig
+from synapse.config.cas import CasConfig
+from synapse.config.sso import SsoAttributeRequirement, SSOConfig
+
+from tests.unittest import TestCase
+
+
+class FakeServer(Config):
+    section = "server"
+
+    def read_config(self, config, **kwargs):
+        self.public_baseurl = config.get("public_baseurl")
+
+
+class TestConfig(RootConfig):
+    config_classes = [FakeServer, CasConfig, SSOConfig]
+
+
+class SSOConfigTestCase(TestCase):
+    def _parse_config(self, config):
+        t = TestConfig()
+        t.parse_config_dict(config, config_dir_path="", data_dir_path="")
+        return t.sso
+
+    def test_static_templates_are_rendered_once(self):
+        """Templates without placeholders should only be read from disk once."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = os.path.join(tmp_dir, "sso_auth_success.html")
+            with open(template_path, "w") as f:
+                f.write("<p>success</p>")
+
+            config = {"sso": {"template_dir": tmp_dir}}
+            sso_config = self._parse_config(config)
+            self.assertEqual(
+                sso_config.sso_templates.rendered("auth_success"), "<p>success</p>"
+            )
+
+            # Changing the file on disk should not affect the next config load.
+            with open(template_path, "w") as f:
+                f.write("<p>changed</p>")
+
+            sso_config = self._parse_config(config)
+            self.assertEqual(
+                sso_config.sso_templates.rendered("auth_success"), "<p>success</p>"
+            )
+
+    def test_templates_are_loaded_lazily(self):
+        """Templates should not be read until they are first used."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sso_config = self._parse_config({"sso": {"template_dir": tmp_dir}})
+
+            # Writing the template after the config has been parsed should still
+            # result in it being used.
+            with open(os.path.join(tmp_dir, "sso_error.html"), "w") as f:
+                f.write("{{ error }}")
+
+            html = sso_config.sso_templates["error"].render(error="oops")
+            self.assertEqual(html, "oops")
+
+    def test_missing_template_dir(self):
+        """A template directory which doesn't exist should be rejected up front."""
+        with self.assertRaises(ConfigError):
+            self._parse_config({"sso": {"template_dir": "a_nonexistent_directory"}})
+
+    def test_templates_not_loaded_without_sso(self):
+        """If SSO is not configured, templates should not be read at startup."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "sso_error.html"), "w") as f:
+                f.write("{% broken")
+
+            # This should not raise, since the broken template is never loaded.
+            self._parse_config({"sso": {"template_dir": tmp_dir}})
+
+            # Nor should a provider which is configured but disabled.
+            self._parse_config(
+                {
+                    "sso": {"template_dir": tmp_dir},
+                    "cas_config": {
+                        "enabled": False,
+                        "server_url": "https://cas.example.com",
+                    },
+                }
+            )
+
+    def test_templates_loaded_with_sso(self):
+        """If SSO is configured, templates should be read (and checked) at startup."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "sso_error.html"), "w") as f:
+                f.write("{% broken")
+
+            config = {
+                "public_baseurl": "https://matrix.example.com/",
+                "sso": {"template_dir": tmp_dir},
+                "cas_config": {"server_url": "https://cas.example.com"},
+            }
+            with self.assertRaises(jinja2.TemplateSyntaxError):
+                self._parse_config(config)
+
+    def test_client_whitelist(self):
+        """Client URLs should match if they start with a whitelisted prefix."""
+        config = {
+            "public_baseurl": "https://matrix.example.com/",
+            "sso": {
+                "client_whitelist": [
+                    "https://riot.im/develop",
+                    "https://my.custom.client/",
+                ]
+            },
+        }
+        matches = self._parse_config(config).is_sso_client_whitelisted
+
+        self.assertTrue(matches("https://riot.im/develop"))
+        self.assertTrue(matches("https://riot.im/develop/#/room"))
+        self.assertTrue(matches("https://my.custom.client/?x=y"))
+        self.assertTrue(
+            matches("https://matrix.example.com/_matrix/static/client/login/")
+        )
+
+        self.assertFalse(matches("https://riot.im/app"))
+        self.assertFalse(matches("https://riot.im/"))
+        self.assertFalse(matches("https://my.custom.client"))
+        self.assertFalse(matches("https://riot.im.evil.com/develop"))
+        self.assertFalse(matches(""))
+
+    def test_empty_client_whitelist(self):
+        """Nothing should match an empty whitelist."""
+        matches = self._parse_config({}).is_sso_client_whitelisted
+        self.assertFalse(matches("https://riot.im/develop"))
+        self.assertFalse(matches(""))
+
+    def test_client_whitelist_is_canonicalised(self):
+        """Duplicate and redundant whitelist entries should be removed."""
+        config = {
+            "public_baseurl": "https://matrix.example.com/",
+            "sso": {
+                "client_whitelist": [
+                    "https://my.custom.client/app/",
+                    " HTTPS://My.Custom.Client/ ",
+                    "https://riot.im/develop",
+                    "https://riot.im/develop",
+                    "https://matrix.example.com/",
+                    "   ",
+                ]
+            },
+        }
+        sso_config = self._parse_config(config)
+
+        self.assertEqual(
+            sso_config.sso_client_whitelist,
+            [
+                "https://my.custom.client/",
+                "https://riot.im/develop",
+                "https://matrix.example.com/",
+            ],
+        )
+
+        # The scheme and host of client URLs should be matched case-insensitively,
+        # but not the rest of the URL.
+        matches = sso_config.is_sso_client_whitelisted
+        self.assertTrue(matches("https://My.Custom.Client/app"))
+        self.assertTrue(matches("HTTPS://RIOT.IM/develop"))
+        self.assertFalse(matches("https://riot.im/DEVELOP"))
+
+        # Whitespace around client URLs should not be ignored, since the client is
+        # redirected to the URL as given.
+        self.assertFalse(matches(" https://riot.im/develop"))
+        self.assertFalse(matches("\xa0https://riot.im/develop"))
+
+    def test_custom_templates_loaded_with_sso(self):
+        """Custom templates should override the defaults when loaded at startup."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "sso_error.html"), "w") as f:
+                f.write("custom: {{ error }}")
+
+            config = {
+                "public_baseurl": "https://matrix.example.com/",
+                "sso": {"template_dir": tmp_dir},
+                "cas_config": {"server_url": "https://cas.example.com"},
+            }
+            sso_templates = self._parse_config(config).sso_templates
+
+        # The templates have already been loaded, so removing the directory doesn't
+        # matter.
+        self.assertEqual(sso_templates["error"].render(error="oops"), "custom: oops")
+        self.assertIn("Thank you", sso_templates.rendered("auth_success"))
+
+    def test_templates_by_name(self):
+        """Templates should be available by name, and as individual attributes."""
+        sso_config = self._parse_config({})
+
+        sso_templates = sso_config.sso_templates
+        self.assertEqual(len(sso_templates), 7)
+        for name in sso_templates:
+            self.assertIsInstance(sso_templates[name], jinja2.Template)
+
+        self.assertIs(sso_templates["error"], sso_config.sso_error_template)
+        self.assertEqual(
+            sso_templates.rendered("auth_success"),
+            sso_config.sso_auth_success_template,
+        )
+
+        with self.assertRaises(KeyError):
+            sso_templates["unknown"]
+
+        # Only templates without placeholders can be rendered up front.
+        with self.assertRaises(KeyError):
+            sso_templates.rendered("error")
+
+    def test_client_whitelist_does_not_modify_config(self):
+        """Adding the login fallback should not change the parsed config."""
+        whitelist = ["https://riot.im/develop"]
+        config = {
+            "public_baseurl": "https://matrix.example.com/",
+            "sso": {"client_whitelist": whitelist},
+        }
+        self._parse_config(config)
+        self.assertEqual(whitelist, ["https://riot.im/develop"])
+
+    def test_client_whitelist_must_be_a_list_of_strings(self):
+        """A client_whitelist which isn't a list of strings should be rejected, rather
+        than (for example) a string being treated as a list of single characters.
+        """
+        for whitelist in ("https://my.client/", ["https://my.client/", 1]):
+            config = {
+                "public_baseurl": "https://matrix.example.com/",
+                "sso": {"client_whitelist": whitelist},
+            }
+            with self.assertRaises(ConfigError):
+                self._parse_config(config)
+
+
+class SsoAttributeRequirementTestCase(TestCase):
+    def test_schema_is_frozen(self):
+        schema = SsoAttributeRequirement.JSON_SCHEMA
+        with self.assertRaises(TypeError):
+            schema["required"] = []
+        with self.assertRaises(TypeError):
+            schema["properties"]["value"] = {}
+
+        # Copies of the schema can be changed without affecting the original.
+        copy = SsoAttributeRequirement.json_schema()
+        copy["required"].append("other")
+        self.assertEqual(
+            SsoAttributeRequirement.JSON_SCHEMA["required"], ("attribute", "value")
+        )
+        jsonschema.validators.validator_for(copy).check_schema(copy)